@@ -1,19 +1,41 @@
 import csv
-import json
+import hashlib
+import multiprocessing
 import os
 import re
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+import bs4
+import orjson
 import requests
-from bs4 import BeautifulSoup
+import soupsieve as sv
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+try:
+    from lxml import etree as lxml_etree
+    PARSER = "lxml"
+except ImportError:
+    lxml_etree = None
+    PARSER = "html.parser"
 
 # ---- 設定 ----
 URLS_CSV = os.getenv("URLS_CSV", "urls.csv")
 CONCURRENCY = int(os.getenv("CONCURRENCY", "6"))
+# HTML解析は CPU バウンドなので、GIL を避けてプロセスで並列化する
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
 TIMEOUT = int(os.getenv("TIMEOUT", "20"))
 RETRIES = int(os.getenv("RETRIES", "2"))
+# 前回取得時の ETag/Last-Modified を保存し、条件付きGETで未更新ページの再取得・再解析を省く
+CACHE_FILE = os.getenv("CACHE_FILE", "docs/.cache.json")
+USE_CACHE = os.getenv("USE_CACHE", "1") == "1"
+OUTPUT_FILES = ["docs/fo-manual.json", "docs/js-part.json"]
+# 出力JSONは機械向けなので既定はコンパクト。人が読む場合は PRETTY=1 でインデント付きにする
+PRETTY = os.getenv("PRETTY", "0") == "1"
+JSON_OPTS = orjson.OPT_INDENT_2 if PRETTY else 0
 
 HEADERS = {
     "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X) AppleWebKit/537.36 "
@@ -29,6 +51,35 @@ ALLOWED_TAGS = {
     "pre", "code", "strong", "em", "a", "br"
 }
 
+# 全スレッドで共有する keep-alive 接続プール（同一ホストへの TCP/TLS 接続を使い回す）
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=CONCURRENCY,
+    pool_maxsize=CONCURRENCY,
+    max_retries=Retry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET",),
+        raise_on_status=False,  # 最終的なステータスは raise_for_status() で扱う
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+_MULTI_NL_RE = re.compile(r"\n{3,}")
+_WS_TABLE = str.maketrans({"\r": "\n", "\t": " ", "\xa0": " "})
+
+# CSSセレクタはページごとに再コンパイルせず、起動時に一度だけコンパイルする
+_SECTION_SEL = sv.compile("section.content-element")
+_JUNK_SEL = sv.compile("header, div.ft_custom01, div.breadcrumbs, div.contents_row")
+_KILL_SEL = sv.compile("script, style, noscript, iframe")
+
+# 使うのは <title> と <body> 配下だけなので、<head> 内の script/style/meta はツリー化しない。
+# html.parser は暗黙の <body> を補わず、<body> のないページが空になるため lxml のときだけ絞り込む
+_PARSE_ONLY = SoupStrainer(["title", "body"]) if PARSER == "lxml" else None
+
 
 def load_urls(path: str):
     if not os.path.exists(path):
@@ -41,69 +92,159 @@ def load_urls(path: str):
             url = row[0].strip()
             if url:
                 urls.append(url)
-    return urls
+    # 重複URLは一度だけ取得する（順序は最初の出現位置を保つ）
+    return list(dict.fromkeys(urls))
+
+
+def cache_signature() -> str:
+    """キャッシュ済みレコードを生成した処理の指紋。変われば前回のレコードは再利用しない。
+
+    抽出処理が参照する定数も含めてこのファイル全体と、出力のシリアライズに影響する
+    パーサ・ライブラリのバージョンを対象にする。
+    """
+    with open(__file__, "rb") as f:
+        h = hashlib.blake2b(f.read(), digest_size=16)
+    lxml_version = ".".join(map(str, lxml_etree.LXML_VERSION)) if lxml_etree else ""
+    for part in (PARSER, bs4.__version__, sv.__version__, lxml_version):
+        h.update(b"\0" + part.encode())
+    return h.hexdigest()
+
+
+def load_cache(path: str, signature: str) -> dict:
+    """前回の条件付きGET用メタ情報 {url: {"etag", "last_modified", "hash"}} を読む。
+
+    抽出処理の指紋が一致しない場合や、ファイルが壊れている場合は空（全件取得）とする。
+    """
+    if not USE_CACHE or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError) as e:
+        print(f"[warn] キャッシュを読めないため全件取得します: {path}: {e}")
+        return {}
+    if not isinstance(data, dict) or data.get("version") != signature:
+        print("[info] スクレイパーまたはパーサのバージョンが変わったため、キャッシュを使わず全件取得します")
+        return {}
+    pages = data.get("pages")
+    if not isinstance(pages, dict):
+        return {}
+    return {u: c for u, c in pages.items() if isinstance(c, dict)}
+
+
+def load_previous_records() -> dict:
+    """前回書き出した出力を {url: レコード} として読む。304 時はこれを再利用する。
+
+    出力が壊れている場合は空（全件取得）とする。
+    """
+    records = {}
+    if not USE_CACHE:
+        return records
+    for path in OUTPUT_FILES:
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, "rb") as f:
+                for obj in orjson.loads(f.read()):
+                    if obj.get("html"):
+                        records[obj["url"]] = obj
+        except (OSError, orjson.JSONDecodeError, TypeError, KeyError, AttributeError) as e:
+            print(f"[warn] 前回の出力を読めないため全件取得します: {path}: {e}")
+            return {}
+    return records
 
 
 def normalize_text(text: str) -> str:
     if not text:
         return ""
-    t = text.replace("\r", "\n").replace("\t", " ").replace("\xa0", " ")
-    t = re.sub(r"\n{3,}", "\n\n", t)
-    return t.strip()
-
-
-def fetch_html(url: str) -> str:
-    last_err = None
-    for i in range(RETRIES + 1):
-        try:
-            r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-            r.raise_for_status()
-            return r.text
-        except Exception as e:
-            last_err = e
-            time.sleep(0.5 * (i + 1))
-    raise last_err
+    t = text.translate(_WS_TABLE)
+    return _MULTI_NL_RE.sub("\n\n", t).strip()
+
+
+def fetch_html(url: str, cached: dict | None = None):
+    """HTMLをデコードせずバイト列のまま返す。文字コードはヘッダで明示されている場合のみ返す。
+
+    cached に前回の ETag/Last-Modified があれば条件付きGETを行い、304 の場合は本文を None で返す。
+    戻り値は (本文, 文字コード, 次回用の ETag/Last-Modified)。
+    """
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["if-none-match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["if-modified-since"] = cached["last_modified"]
+
+    # 接続失敗・5xx のリトライは SESSION のアダプタが行う。ヘッダ受信後の本文読み込み中の
+    # 切断・展開失敗はアダプタの対象外なので、ここで1回だけ再取得する
+    try:
+        r = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+    except (requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ContentDecodingError,
+            requests.exceptions.ConnectionError):
+        time.sleep(0.5)
+        r = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+    if r.status_code == 304:
+        return None, None, cached
+    r.raise_for_status()
+
+    # PDF や JSON など HTML 以外はパースせず失敗扱いにする（リトライもしない）
+    ctype = r.headers.get("content-type", "").lower()
+    if ctype and "html" not in ctype:
+        raise ValueError(f"HTMLではないレスポンスです: {ctype}")
+
+    encoding = r.encoding if "charset=" in ctype else None
+    validators = {
+        "etag": r.headers.get("etag"),
+        "last_modified": r.headers.get("last-modified"),
+    }
+    return r.content, encoding, validators
 
 
 def clean_section_keep_headings(sec: BeautifulSoup) -> str:
     """section要素内をクリーンアップし、見出し等の最低限のタグは保持してHTMLとして返す。"""
 
     # 完全削除対象
-    for tag in sec.find_all(["script", "style", "noscript", "iframe"]):
-        tag.decompose()
+    for tag in _KILL_SEL.select(sec):
+        tag.extract()
 
-    # 属性の削除（<a> だけ href を残す）
+    # 属性の削除（<a> だけ href を残す）と、許可タグ以外の unwrap を1回の走査で行う
     for tag in sec.find_all(True):
         if tag.name == "a":
             href = tag.get("href")
-            tag.attrs = {}
-            if href:
-                tag["href"] = href
+            tag.attrs = {"href": href} if href else {}
         else:
             tag.attrs = {}
-
-    # unwrap処理（ただし .code_row クラスがあるタグは除外）
-    for tag in list(sec.find_all(True)):
         if tag.name not in ALLOWED_TAGS:
-            classes = tag.get("class") or []
-            if "code_row" in classes:
-                continue  # ✅ .code_row クラス付きはそのまま残す
             tag.unwrap()
 
     html = str(sec)
     return normalize_text(html)
 
 
-def extract_title_and_text(html: str, url: str):
-    soup = BeautifulSoup(html, "lxml")
+def document_title(soup: BeautifulSoup) -> str:
+    """文書の <title> だけを読む（<body> 内の <svg><title> などは対象外）。"""
+    if soup.head:
+        tag = soup.head.find("title", recursive=False)
+    else:
+        # strainer 使用時は <head> が作られず <title> が最上位に残る。
+        # <head> 省略時の html.parser では <html> 直下に置かれる
+        tag = soup.find("title", recursive=False)
+        if tag is None and soup.html:
+            tag = soup.html.find("title", recursive=False)
+    return (tag.string or "").strip() if tag else ""
+
+
+def extract_title_and_text(html: bytes, url: str, encoding: str | None = None):
+    soup = BeautifulSoup(html, PARSER, parse_only=_PARSE_ONLY, from_encoding=encoding)
+
+    # <title> は DOM を書き換える前に、構築済みのツリーから読む
+    title = document_title(soup)
 
-    for header in soup.find_all("header"):
-        header.decompose()
-    for cls in ["ft_custom01", "breadcrumbs", "contents_row"]:
-        for div in soup.find_all("div", class_=cls):
-            div.decompose()
+    # soup はこの関数内で捨てるので、decompose() より軽い extract() で切り離すだけにする
+    for node in _JUNK_SEL.select(soup):
+        node.extract()
 
-    sections = soup.find_all("section", class_="content-element")
+    sections = _SECTION_SEL.select(soup)
     if sections:
         cleaned = [clean_section_keep_headings(sec) for sec in sections]
         text_html = "\n\n".join(cleaned)
@@ -111,58 +252,98 @@ def extract_title_and_text(html: str, url: str):
         root = soup.body or soup
         text_html = clean_section_keep_headings(root)
 
-    title = (soup.title.string if soup.title else "") or ""
-    title = title.strip() if title else ""
     if not title:
         h1 = soup.find("h1")
-        title = (h1.get_text(strip=True) if h1 else "") or "記事の詳細"
+        title = h1.get_text(strip=True) if h1 else ""
 
     return {"title": title or "記事の詳細", "url": url, "html": text_html}
 
 
 def main():
+    os.makedirs("docs", exist_ok=True)
+
     urls = load_urls(URLS_CSV)
     if not urls:
+        # 0件でも通常の書き出し処理で空の配列を出力する
         print("URLが0件でした。空の配列を書き出します。")
-        os.makedirs("docs", exist_ok=True)
-        with open("docs/fo-manual.json", "w", encoding="utf-8") as f:
-            json.dump([], f, ensure_ascii=False, indent=2)
-        with open("docs/js-part.json", "w", encoding="utf-8") as f:
-            json.dump([], f, ensure_ascii=False, indent=2)
-        return
 
-    results_fo = []
-    results_js = []
+    # 前回の出力が残っているURLだけ条件付きGETの対象にする
+    signature = cache_signature()
+    previous = load_previous_records()
+    cache = {u: c for u, c in load_cache(CACHE_FILE, signature).items() if u in previous}
+    new_cache = {}
+    reused = 0
 
-    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
-        futures = {ex.submit(fetch_html, url): url for url in urls}
+    # urls.csv の順序を保つため、位置で結果を格納する
+    results = [None] * len(urls)
+
+    # 解析プロセスは取得スレッドが通信中に起動されるため、マルチスレッド状態からの fork を避けて
+    # spawn で起動する（fork だと子プロセスが他スレッドの保持中のロックを引き継ぎデッドロックしうる）
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex, \
+            ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                mp_context=multiprocessing.get_context("spawn")) as parse_pool:
+        futures = {ex.submit(fetch_html, url, cache.get(url)): i for i, url in enumerate(urls)}
+        parse_futures = {}
 
         for fut in tqdm(as_completed(futures), total=len(futures), desc="fetch"):
-            url = futures[fut]
+            i = futures[fut]
+            url = urls[i]
+            try:
+                html, encoding, entry = fut.result()
+                if html is None:
+                    # 304 Not Modified: 前回のレコードをそのまま使う
+                    results[i] = previous[url]
+                    reused += 1
+                else:
+                    entry = {**entry, "hash": hashlib.blake2b(html, digest_size=16).hexdigest()}
+                    if cache.get(url, {}).get("hash") == entry["hash"]:
+                        # 本文が前回と同一なら再解析しない
+                        results[i] = previous[url]
+                        reused += 1
+                    else:
+                        # 取得スレッドを塞がないよう、解析は別プロセスに渡す（渡すのは bytes と str のみ）
+                        pf = parse_pool.submit(extract_title_and_text, html, url, encoding)
+                        parse_futures[pf] = i
+                new_cache[url] = entry
+            except Exception as e:
+                results[i] = {"title": "記事の詳細", "url": url, "html": ""}
+                print(f"[warn] {url}: {e}")
+
+        for fut in tqdm(as_completed(parse_futures), total=len(parse_futures), desc="parse"):
+            i = parse_futures[fut]
+            url = urls[i]
             try:
-                html = fut.result()
-                obj = extract_title_and_text(html, url)
+                results[i] = fut.result()
             except Exception as e:
-                obj = {"title": "記事の詳細", "url": url, "html": ""}
+                results[i] = {"title": "記事の詳細", "url": url, "html": ""}
+                new_cache.pop(url, None)  # 次回は再取得・再解析させる
                 print(f"[warn] {url}: {e}")
 
-            if "fo-guidebook.hmup.jp" in url:
-                results_fo.append(obj)
-            elif "js-part.hmup.jp" in url:
-                results_js.append(obj)
-            else:
-                print(f"[warn] 未分類のURL: {url}")
+    results_fo = []
+    results_js = []
+    for obj in results:
+        url = obj["url"]
+        if "fo-guidebook.hmup.jp" in url:
+            results_fo.append(obj)
+        elif "js-part.hmup.jp" in url:
+            results_js.append(obj)
+        else:
+            print(f"[warn] 未分類のURL: {url}")
 
-    os.makedirs("docs", exist_ok=True)
+    with open("docs/fo-manual.json", "wb") as f:
+        f.write(orjson.dumps(results_fo, option=JSON_OPTS))
 
-    with open("docs/fo-manual.json", "w", encoding="utf-8") as f:
-        json.dump(results_fo, f, ensure_ascii=False, indent=2)
+    with open("docs/js-part.json", "wb") as f:
+        f.write(orjson.dumps(results_js, option=JSON_OPTS))
 
-    with open("docs/js-part.json", "w", encoding="utf-8") as f:
-        json.dump(results_js, f, ensure_ascii=False, indent=2)
+    if USE_CACHE:
+        with open(CACHE_FILE, "wb") as f:
+            manifest = {"version": signature, "pages": new_cache}
+            f.write(orjson.dumps(manifest, option=JSON_OPTS | orjson.OPT_SORT_KEYS))
 
     print(f"✅ written: docs/fo-manual.json  ({len(results_fo)} items)")
     print(f"✅ written: docs/js-part.json    ({len(results_js)} items)")
+    print(f"♻️ reused (unchanged): {reused} items")
 
 
 if __name__ == "__main__":